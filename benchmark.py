@@ -0,0 +1,70 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_pwf_server import FakeDataset, FakePWFServer, default_window
+
+# End-to-end benchmark of timesheets_script.py against the local fake API at several data sizes.
+# Each run is a fresh process with an empty output folder and local store, so the numbers are for a cold run.
+
+SCALES = {
+    # name: (staff, projects, records per project)
+    'small': (5, 10, 50),
+    'medium': (20, 60, 150),
+    'large': (40, 200, 400),
+}
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'timesheets_script.py')
+
+# Run the script once against the server, returning (seconds, exit code, peak RSS in MB)
+def run_script(server_url, workdir, extra_env=None):
+    window_start, window_end = default_window()
+    env = {
+        **os.environ,
+        'PWF_BASE_URL': server_url,
+        'PWF_TRACKED_FROM': window_start.strftime('%Y-%m-%d'),
+        'PWF_TRACKED_TO': window_end.strftime('%Y-%m-%d'),
+        'PWF_OUTPUT_DIR': os.path.join(workdir, 'output'),
+        'PWF_STORE_PATH': os.path.join(workdir, 'pwf_store.sqlite'),
+        **(extra_env or {}),
+    }
+    with open(os.path.join(workdir, 'run.log'), 'ab') as log:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, SCRIPT], env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return elapsed, os.waitstatus_to_exitcode(status), peak_mb
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark timesheets_script.py against a local fake ProWorkflow API")
+    parser.add_argument('--scales', default='small,medium', help=f"Comma-separated scales to run, from {', '.join(SCALES)}")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds the fake server waits before answering each request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests the fake server answers with a 429 or 503")
+    parser.add_argument('--warm', action='store_true', help="Also time a second run that reuses the local store")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help="Extra environment for the script, e.g. PWF_EXCEL_ENGINE=xlsxwriter")
+    args = parser.parse_args()
+
+    extra_env = dict(item.split('=', 1) for item in args.env)
+    print(f"{'scale':<8} {'run':<5} {'records':>8} {'seconds':>8} {'API calls':>10} {'peak MB':>8}")
+    for scale in args.scales.split(','):
+        staff, projects, records_per_project = SCALES[scale]
+        dataset = FakeDataset(staff, projects, records_per_project)
+        with FakePWFServer(dataset, latency=args.latency, error_rate=args.error_rate) as server, \
+                tempfile.TemporaryDirectory() as workdir:
+            for run in ['cold', 'warm'] if args.warm else ['cold']:
+                calls_before = server.request_count
+                elapsed, exit_code, peak_mb = run_script(server.url, workdir, extra_env)
+                calls = server.request_count - calls_before
+                print(f"{scale:<8} {run:<5} {dataset.record_count:>8} {elapsed:>8.2f} {calls:>10} {peak_mb:>8.1f}")
+                if exit_code != 0:
+                    with open(os.path.join(workdir, 'run.log')) as log:
+                        print(log.read()[-2000:])
+                    raise SystemExit(f"timesheets_script.py exited with status {exit_code} at scale '{scale}'")
+
+if __name__ == "__main__":
+    main()
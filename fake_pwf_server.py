@@ -0,0 +1,261 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for the parts of the ProWorkflow API used by timesheets_script.py, serving synthetic data.
+# Point the script at it with PWF_BASE_URL=http://127.0.0.1:<port>
+# Every list response's 'count' is the total number of matching items across all pages, not the length of the
+# page returned, which is the meaning timesheets_script.py checks its paged fetches against.
+
+CATEGORIES = ["Current Timed Projects", "On Hold", "Internal"]
+TASK_NAMES = ["Design", "Development", "Review", "Meetings", "Admin", "Testing"]
+# Time record keys returned for each group in a fields= parameter, the record id is always included
+FIELD_GROUPS = {
+    'dates': ['starttime', 'endtime'],
+    'project': ['projectid', 'projecttitle', 'projectnumber'],
+    'task': ['taskid', 'taskname'],
+    'notes': ['notes'],
+    'contact': ['contactid'],
+    'category': ['categoryname'],
+}
+
+# First and last day of the tracked window: the previous month plus the ten months before it, as in the script
+def default_window(today=None, months=11):
+    today = today or datetime.today()
+    window_end = datetime(today.year, today.month, 1) - timedelta(days=1)
+    start_month = window_end.year * 12 + window_end.month - months
+    window_start = datetime(start_month // 12, start_month % 12 + 1, 1)
+    return window_start, window_end
+
+# Synthetic contacts, time records and invoices, generated deterministically from a seed
+class FakeDataset:
+    def __init__(self, staff=10, projects=20, records_per_project=100, seed=0, window=None):
+        rng = random.Random(seed)
+        window_start, window_end = window or default_window()
+        window_minutes = int((window_end + timedelta(days=1) - window_start).total_seconds() // 60)
+
+        self.contacts = [
+            {'id': contact_id, 'firstname': f"Staff{contact_id}", 'lastname': f"Member{contact_id}", 'type': 'staff'}
+            for contact_id in range(1, staff + 1)
+        ]
+        # A few non-staff contacts, which the script should ignore
+        self.contacts += [
+            {'id': 10000 + n, 'firstname': f"Client{n}", 'lastname': "Contact", 'type': 'client'}
+            for n in range(max(1, staff // 5))
+        ]
+
+        self.time_records = {contact['id']: [] for contact in self.contacts}
+        self.invoices = {}
+        record_id = 1
+        for project_index in range(projects):
+            project_id = 1000 + project_index
+            project_title = f"Project {project_index} / {rng.choice(['Website', 'Brand', 'Campaign', 'App'])}"
+            project_number = f"{project_index:04d}"
+            for _ in range(records_per_project):
+                contact_id = rng.randint(1, staff)
+                start = window_start + timedelta(minutes=rng.randrange(window_minutes))
+                end = start + timedelta(minutes=rng.randint(5, 240))
+                self.time_records[contact_id].append({
+                    'id': record_id,
+                    'projectid': project_id,
+                    'projecttitle': project_title,
+                    'projectnumber': project_number,
+                    'taskid': project_id * 10 + rng.randrange(len(TASK_NAMES)),
+                    'taskname': rng.choice(TASK_NAMES),
+                    'notes': rng.choice(["", "Call with client", "Revisions after feedback", "Internal review"]),
+                    'starttime': start.strftime("%Y-%m-%dT%H:%M:%S"),
+                    'endtime': end.strftime("%Y-%m-%dT%H:%M:%S"),
+                    'categoryname': rng.choices(CATEGORIES, weights=[6, 2, 1])[0],
+                    'contactid': contact_id,
+                })
+                record_id += 1
+
+            # Roughly two thirds of projects have been invoiced at least once
+            if rng.random() < 2 / 3:
+                self.invoices[project_id] = [
+                    {
+                        'id': project_id * 100 + n,
+                        'projectid': project_id,
+                        'invoiceddate': (window_start + timedelta(minutes=rng.randrange(window_minutes))).strftime("%Y-%m-%dT%H:%M:%S"),
+                        'status': rng.choice(['paid', 'sent']),
+                    }
+                    for n in range(rng.randint(1, 4))
+                ]
+
+        for records in self.time_records.values():
+            records.sort(key=lambda record: record['starttime'])
+
+    @property
+    def record_count(self):
+        return sum(len(records) for records in self.time_records.values())
+
+# Only the requested field groups of a time record
+def select_fields(record, fields):
+    keys = ['id'] + [key for group in fields.split(',') for key in FIELD_GROUPS.get(group, [])]
+    return {key: record[key] for key in keys}
+
+# One page of a list, when pagenumber and pagesize are given
+def page(items, query):
+    if 'pagesize' not in query:
+        return items
+    page_size = int(query['pagesize'][0])
+    page_number = int(query.get('pagenumber', ['1'])[0])
+    return items[(page_number - 1) * page_size:page_number * page_size]
+
+# Threaded HTTP server answering /contacts, /contacts/{id}/time, /invoices and /projects/{id}/invoices/,
+# with optional per-request latency and a share of requests throttled (429) or failing (503) with a Retry-After.
+# Supports the type=, categories=, fields= and pagenumber/pagesize parameters the script sends;
+# with paging=False it ignores the paging parameters, like a server without paging support, and with
+# max_page_size it returns at most that many items per page whatever page size is asked for.
+class FakePWFServer:
+    def __init__(self, dataset, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, retry_after=1, seed=0, paging=True,
+                 max_page_size=None):
+        self.dataset = dataset
+        self.paging = paging
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_counts = Counter()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def request_count(self):
+        with self.lock:
+            return sum(self.request_counts.values())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Work out the response for a request path, as (status, JSON body)
+    def respond(self, path, query):
+        if not self.paging:
+            query = {key: value for key, value in query.items() if key not in ('pagenumber', 'pagesize')}
+        elif self.max_page_size and 'pagesize' in query:
+            query = {**query, 'pagesize': [str(min(int(query['pagesize'][0]), self.max_page_size))]}
+        with self.lock:
+            fail = self.rng.random() < self.error_rate
+        if fail:
+            self._count('injected errors')
+            return self.rng.choice([429, 503]), {'status': 'error', 'message': "Injected error"}
+
+        if path == '/contacts':
+            self._count('/contacts')
+            contacts = self.dataset.contacts
+            if 'type' in query:
+                contacts = [contact for contact in contacts if contact['type'] == query['type'][0]]
+            return 200, {'count': len(contacts), 'contacts': page(contacts, query)}
+
+        match = re.fullmatch(r'/contacts/(\d+)/time', path)
+        if match:
+            self._count('/contacts/{id}/time')
+            trackedfrom = query.get('trackedfrom', ['0000-00-00'])[0]
+            trackedto = query.get('trackedto', ['9999-99-99'])[0]
+            categories = query['categories'][0].split(',') if 'categories' in query else None
+            records = [
+                record for record in self.dataset.time_records.get(int(match.group(1)), [])
+                if trackedfrom <= record['starttime'][:10] <= trackedto
+                and (categories is None or record['categoryname'] in categories)
+            ]
+            count = len(records)
+            records = page(records, query)
+            if 'fields' in query:
+                records = [select_fields(record, query['fields'][0]) for record in records]
+            return 200, {'count': count, 'timerecords': records}
+
+        if path == '/invoices':
+            self._count('/invoices')
+            invoices = [invoice for project_invoices in self.dataset.invoices.values() for invoice in project_invoices]
+            return 200, {'count': len(invoices), 'invoices': page(invoices, query)}
+
+        match = re.fullmatch(r'/projects/(\d+)/invoices/?', path)
+        if match:
+            self._count('/projects/{id}/invoices/')
+            invoices = self.dataset.invoices.get(int(match.group(1)), [])
+            return 200, {'count': len(invoices), 'invoices': invoices}
+
+        self._count('other')
+        return 404, {'status': 'error', 'message': f"Unknown endpoint {path}"}
+
+    def _count(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] += 1
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                url = urlparse(self.path)
+                status, body = server.respond(url.path, parse_qs(url.query))
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                if status in (429, 503) and server.retry_after is not None:
+                    self.send_header('Retry-After', str(server.retry_after))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic ProWorkflow data for offline runs of timesheets_script.py")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--staff', type=int, default=10)
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--records-per-project', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before answering each request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with a 429 or 503")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-paging', action='store_true', help="Ignore pagenumber/pagesize and always return whole lists")
+    parser.add_argument('--max-page-size', type=int, default=None, help="Return at most this many items per page")
+    args = parser.parse_args()
+
+    dataset = FakeDataset(args.staff, args.projects, args.records_per_project, seed=args.seed)
+    server = FakePWFServer(dataset, port=args.port, latency=args.latency, error_rate=args.error_rate, seed=args.seed,
+                           paging=not args.no_paging, max_page_size=args.max_page_size)
+    window_start, window_end = default_window()
+    print(f"Serving {dataset.record_count} time records for {args.staff} staff on {server.url}")
+    print(f"Run the script with PWF_BASE_URL={server.url} PWF_TRACKED_FROM={window_start:%Y-%m-%d} PWF_TRACKED_TO={window_end:%Y-%m-%d}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,45 @@
+import bisect
+import json
 import os
+import random
+import re
+import sqlite3
+import threading
 import time
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qsl, urlencode, urlparse
 
 import openpyxl
 import pandas as pd
 import requests
 from dotenv import load_dotenv
-from openpyxl.styles import Alignment, Font, PatternFill
+from openpyxl.styles import Alignment, Font, NamedStyle, PatternFill
 from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.hyperlink import Hyperlink
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import xlsxwriter
+except ImportError:  # Only needed when PWF_EXCEL_ENGINE is 'xlsxwriter'
+    xlsxwriter = None
+
+try:
+    import pyarrow
+except ImportError:  # Only needed when PWF_OUTPUT_MODE includes 'parquet'
+    pyarrow = None
 
 load_dotenv()
 
 # Define your API credentials
 API_KEY = os.getenv('PWF_API_KEY')  # Replace with your actual ProWorkflow API key
-BASE_URL = 'https://api.proworkflow.net'  # Base URL for the ProWorkflow API
+BASE_URL = os.getenv('PWF_BASE_URL', 'https://api.proworkflow.net')  # Base URL for the ProWorkflow API (override to point at fake_pwf_server.py)
 USERNAME = os.getenv('PWF_USERNAME')  # Replace with your ProWorkflow username
 PASSWORD = os.getenv('PWF_PASSWORD')  # Replace with your ProWorkflow password
 
@@ -26,134 +51,763 @@ headers = {
 
 pd.set_option('display.max_colwidth', None)
 
-trackedfrom = '2024-10-01'  # Specify start date for the time range
-trackedto = '2025-08-31'   # Specify end date for the time range
+REPORT_MONTHS = os.getenv('PWF_REPORT_MONTHS')  # Backfill range such as '2025-06:2025-08', defaults to the previous month
+# Cut each month off at the invoices dated up to its last day, as it stood at the time, instead of all invoices to date
+INVOICES_AS_OF_MONTH_END = os.getenv('PWF_INVOICES_AS_OF_MONTH_END', '').lower() in ('1', 'true', 'yes')
+TRACKED_MONTHS = int(os.getenv('PWF_TRACKED_MONTHS', '11'))  # Months of time records behind each report, ending with the report month
+trackedfrom = os.getenv('PWF_TRACKED_FROM')  # Optional start date for the time range, defaults to TRACKED_MONTHS before the first report month
+trackedto = os.getenv('PWF_TRACKED_TO')   # Optional end date for the time range, defaults to the end of the last report month
+
+TIME_RECORD_CATEGORIES = ["On Hold", "Current Timed Projects"]  # Time record categories included in the timesheets
+TIME_RECORD_COLUMNS = ['projectid', 'projecttitle', 'projectnumber', 'taskname', 'notes', 'starttime', 'endtime', 'categoryname']
+RECORD_COLUMNS = ['project_name', 'project_number', 'task_name', 'staff', 'notes', 'start', 'end', 'minutes']  # Filtered, typed records
+RECORD_CATEGORY_COLUMNS = ['project_name', 'project_number', 'task_name', 'staff']  # Repeated names, interned as categoricals
+TIME_RECORD_FIELDS = 'dates,project,task,notes,category'  # Field groups requested for time records
+PAGE_SIZE = int(os.getenv('PWF_PAGE_SIZE', '0'))  # Records per page for paged API requests, 0 to fetch everything in one response
+
+MAX_WORKERS = int(os.getenv('PWF_MAX_WORKERS', '8'))  # Maximum number of API requests in flight at once
+RATE_LIMIT = float(os.getenv('PWF_RATE_LIMIT', '0'))  # Maximum API requests per second across all threads, 0 for no limit
+MAX_RETRIES = int(os.getenv('PWF_MAX_RETRIES', '3'))  # Retries for network errors, 429 and 5xx responses
+BACKOFF_BASE = float(os.getenv('PWF_BACKOFF_BASE', '1'))  # Seconds; the backoff ceiling doubles with each retry
+BACKOFF_CAP = float(os.getenv('PWF_BACKOFF_CAP', '60'))  # Longest single wait in seconds, including Retry-After
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+STRIPPED_CACHE_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}  # Describe the wire body, not the cached one
+
+STORE_PATH = os.getenv('PWF_STORE_PATH', 'pwf_store.sqlite')  # Local time record store, set to an empty string to disable
+SYNC_OVERLAP_DAYS = int(os.getenv('PWF_SYNC_OVERLAP_DAYS', '7'))  # Days before the last sync to re-fetch, to pick up late edits
+INVOICE_CUTOFF_TTL_HOURS = float(os.getenv('PWF_INVOICE_CUTOFF_TTL_HOURS', '0'))  # How long stored invoice dates are used without re-fetching, 0 to fetch every run and keep them only as a fallback
+INVOICE_INDEX = os.getenv('PWF_INVOICE_INDEX', '1').lower() in ('1', 'true', 'yes')  # Fetch all invoices in one paged listing instead of per project
+EXCEL_ENGINE = os.getenv('PWF_EXCEL_ENGINE', 'openpyxl')  # 'openpyxl', or 'xlsxwriter' for faster streaming output
+OUTPUT_DIR = os.getenv('PWF_OUTPUT_DIR', 'output/projects')  # Folder the monthly timesheet folders are created in
+# Comma-separated outputs for each report month: 'files' (a workbook per project), 'workbook' (every project in one workbook),
+# 'parquet' and 'csv' (the filtered records and per-staff totals for downstream analysis)
+OUTPUT_MODES = [mode.strip() for mode in os.getenv('PWF_OUTPUT_MODE', 'files').split(',') if mode.strip()]
+EXPORT_WORKERS = int(os.getenv('PWF_EXPORT_WORKERS', os.cpu_count() or 1))  # Worker processes writing workbooks, 1 writes them in-process
+STREAMING = os.getenv('PWF_STREAMING', '').lower() in ('1', 'true', 'yes')  # Write each workbook as soon as all its contributors are fetched
+REPORT_JSON = os.getenv('PWF_REPORT_JSON')  # Optional path to write the run report to as JSON
+HTTP_CACHE_MODE = os.getenv('PWF_HTTP_CACHE', 'off')  # 'off', 'on' (use fresh cached responses), 'record' (always fetch and store) or 'replay' (cache only, no network)
+HTTP_CACHE_PATH = os.getenv('PWF_HTTP_CACHE_PATH', 'pwf_http_cache.sqlite')  # File the HTTP cache is kept in
+HTTP_CACHE_TTL_HOURS = float(os.getenv('PWF_HTTP_CACHE_TTL_HOURS', '24'))  # How long a cached response is used in 'on' mode
+
+# Stage timings and HTTP counters for one run, safe to update from worker threads
+class RunStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {}  # stage name -> {'seconds': total time, 'calls': times entered}
+        self.requests = {}  # endpoint -> {'requests', 'bytes', 'seconds'}
+        self.statuses = Counter()
+        self.retries = 0
+        self.backoff_seconds = 0.0
+        self.cache_hits = 0
+
+    # Time a block of work under a stage name; stages entered from several threads add up their time
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stages({name: {'seconds': time.perf_counter() - started, 'calls': 1}})
+
+    # Fold stage timings in, e.g. those handed back by an export worker process
+    def add_stages(self, stages):
+        with self.lock:
+            for name, stage in stages.items():
+                totals = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                totals['seconds'] += stage['seconds']
+                totals['calls'] += stage['calls']
+
+    def record_request(self, url, status, size, seconds):
+        endpoint = re.sub(r'/\d+', '/{id}', urlparse(url).path)
+        with self.lock:
+            totals = self.requests.setdefault(endpoint, {'requests': 0, 'bytes': 0, 'seconds': 0.0})
+            totals['requests'] += 1
+            totals['bytes'] += size
+            totals['seconds'] += seconds
+            self.statuses[status] += 1
+
+    def record_cache_hit(self):
+        with self.lock:
+            self.cache_hits += 1
+
+    def record_retry(self, wait_time):
+        with self.lock:
+            self.retries += 1
+            self.backoff_seconds += wait_time
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'total_seconds': time.perf_counter() - self.started,
+                'stages': self.stages,
+                'requests': self.requests,
+                'total_requests': sum(totals['requests'] for totals in self.requests.values()),
+                'bytes_received': sum(totals['bytes'] for totals in self.requests.values()),
+                'statuses': {str(status): count for status, count in self.statuses.items()},
+                'retries': self.retries,
+                'backoff_seconds': self.backoff_seconds,
+                'cache_hits': self.cache_hits,
+            }
+
+    def summary(self):
+        report = self.as_dict()
+        lines = [f"Run report: {report['total_seconds']:.2f}s total"]
+        for name, stage in report['stages'].items():
+            lines.append(f"  {name:<20} {stage['seconds']:>9.2f}s  ({stage['calls']} calls)")
+        lines.append(
+            f"  HTTP: {report['total_requests']} requests, {report['bytes_received'] / 1e6:.2f} MB received, "
+            f"{report['retries']} retries, {report['backoff_seconds']:.1f}s in backoff, "
+            f"{report['cache_hits']} served from the HTTP cache"
+        )
+        for endpoint, totals in report['requests'].items():
+            lines.append(f"    {endpoint:<30} {totals['requests']:>6} requests {totals['bytes'] / 1e6:>8.2f} MB {totals['seconds']:>8.2f}s")
+        return "\n".join(lines)
+
+stats = RunStats()
+
+_session = None
+_session_lock = threading.Lock()
+
+# Shared session so every request reuses pooled connections and the same authentication
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.headers.update(headers)
+            session.auth = HTTPBasicAuth(USERNAME, PASSWORD)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+# Token bucket limiting the request rate across all threads; a rate of 0 turns it off
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until a token is available, then take it
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+# Limit on requests in flight that adapts to the error rate: it grows by one for every window of
+# successful requests and halves when the server throttles or fails (additive increase, multiplicative decrease)
+class AdaptiveConcurrencyLimit:
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.lowest = max_limit
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            # Requests already in flight when the server started struggling only count once
+            now = time.monotonic()
+            if now - self.last_decrease >= 1.0:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.lowest = min(self.lowest, int(self.limit))
+                self.last_decrease = now
+
+# Single retry, backoff and rate-limiting policy shared by every API endpoint
+class HttpPolicy:
+    def __init__(self, rate_limit=RATE_LIMIT, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 backoff_cap=BACKOFF_CAP, max_concurrency=MAX_WORKERS):
+        self.bucket = TokenBucket(rate_limit)
+        self.concurrency = AdaptiveConcurrencyLimit(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    # Seconds to wait before the next attempt: the server's Retry-After if it sent one, else jittered exponential backoff
+    def wait_time(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(self.backoff_cap, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(retry_after)
+                    return min(self.backoff_cap, max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds()))
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    # GET a URL, retrying network errors and retryable statuses. Returns the last response once retries run
+    # out, so callers still see the final status; raises if every attempt failed at the network level.
+    def get(self, url):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            with self.concurrency.slot():
+                started = time.perf_counter()
+                try:
+                    response = get_session().get(url)
+                except requests.exceptions.RequestException as e:
+                    stats.record_request(url, 'error', 0, time.perf_counter() - started)
+                    if attempt == self.max_retries:
+                        raise
+                    self.concurrency.on_throttle()
+                    wait_time = self.wait_time(attempt)
+                    print(f"Network error for {url}: {e}. Retrying in {wait_time:.1f} seconds...")
+                else:
+                    stats.record_request(url, response.status_code, len(response.content), time.perf_counter() - started)
+                    if response.status_code not in RETRY_STATUSES:
+                        self.concurrency.on_success()
+                        return response
+                    self.concurrency.on_throttle()
+                    if attempt == self.max_retries:
+                        return response
+                    wait_time = self.wait_time(attempt, response)
+                    print(f"Server returned {response.status_code} for {url}. Retrying in {wait_time:.1f} seconds...")
+            stats.record_retry(wait_time)
+            time.sleep(wait_time)
+
+http_policy = HttpPolicy()
+
+# On-disk cache of successful API responses, keyed by URL with its query parameters in a canonical order.
+# Bodies are stored zlib-compressed with the time they were fetched.
+class HttpCache:
+    def __init__(self, path, mode=HTTP_CACHE_MODE, ttl_hours=HTTP_CACHE_TTL_HOURS):
+        self.mode = mode
+        self.ttl = timedelta(hours=ttl_hours)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    status INTEGER NOT NULL,
+                    headers TEXT NOT NULL,
+                    body BLOB NOT NULL,
+                    fetched_at TEXT NOT NULL
+                )
+            """)
+
+    @staticmethod
+    def key(url):
+        parts = urlparse(url)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return parts._replace(query=query, fragment='').geturl()
+
+    # The cached response for a URL, or None if there isn't a usable one. In 'on' mode only fresh entries
+    # are used, in 'replay' mode any entry is, and a missing one is an error rather than a network request.
+    def get(self, url):
+        if self.mode == 'record':
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, headers, body, fetched_at FROM responses WHERE key = ?", (self.key(url),)
+            ).fetchone()
+        if row is None or (self.mode == 'on' and datetime.now() - datetime.fromisoformat(row[3]) > self.ttl):
+            if self.mode == 'replay':
+                raise Exception(f"No cached response for {url} to replay, record one first with PWF_HTTP_CACHE=record")
+            return None
+        status, response_headers, body, _ = row
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(json.loads(response_headers))
+        response._content = zlib.decompress(body)
+        response.url = url
+        response.encoding = 'utf-8'
+        return response
+
+    def put(self, url, response):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, status, headers, body, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (self.key(url), response.status_code, json.dumps({name: value for name, value in response.headers.items() if name.lower() not in STRIPPED_CACHE_HEADERS}),
+                 zlib.compress(response.content), datetime.now().isoformat(timespec='seconds')),
+            )
+
+_http_cache = None
+_http_cache_lock = threading.Lock()
+
+# The shared HTTP cache, or None when PWF_HTTP_CACHE is 'off'
+def get_http_cache():
+    global _http_cache
+    if HTTP_CACHE_MODE == 'off':
+        return None
+    with _http_cache_lock:
+        if _http_cache is None:
+            _http_cache = HttpCache(HTTP_CACHE_PATH)
+    return _http_cache
+
+# GET an API URL through the HTTP cache, if enabled, then the shared session and HTTP policy,
+# counting the request for the run report. Only 200 responses are cached.
+def api_get(url):
+    http_cache = get_http_cache()
+    if http_cache:
+        response = http_cache.get(url)
+        if response is not None:
+            stats.record_cache_hit()
+            return response
+    response = http_policy.get(url)
+    if http_cache and response.status_code == 200:
+        http_cache.put(url, response)
+    return response
 
 # Function to get all contacts of type 'staff'
 def get_staff_contacts():
-    url = f'{BASE_URL}/contacts'
-    response = requests.get(url, headers=headers, auth=HTTPBasicAuth(USERNAME, PASSWORD))
-    if response.status_code == 200:
-        contacts = response.json()['contacts']
-        print("Collected staff names...")
-        return [contact for contact in contacts if contact['type'] == 'staff']
-    else:
-        raise Exception(f"Error fetching contacts: {response.status_code}, {response.text}")
-
-# Second request: Function to get task-specific time details by contact
+    contacts = iter_api_pages(f'{BASE_URL}/contacts', {'type': 'staff'}, 'contacts', "contacts")
+    # The type filter is also applied here, for servers that ignore it
+    staff = [contact for contact in contacts if contact['type'] == 'staff']
+    print("Collected staff names...")
+    return staff
+
+# Yield the items of a list endpoint page by page, so no single response holds the whole list.
+# A page shorter than asked for doesn't end the list, as the server may cap its page size: paging goes on until
+# a page comes back empty or the count the first response reports has been received. If a page comes back larger
+# than asked for or repeats the previous one the server is taken to be ignoring paging and what it sent is
+# treated as the full list. The items received must add up to the reported count, and with require_count a
+# response without one is an error too.
+# 'count' is taken to be the total number of matching items across all pages, as fake_pwf_server.py models it.
+# That hasn't been confirmed against a paged response from the live API, so paging is off unless PWF_PAGE_SIZE is set.
+def iter_api_pages(url, params, key, description, page_size=None, require_count=False):
+    page_size = PAGE_SIZE if page_size is None else page_size
+    page_number = 1
+    previous_first = None
+    total = None
+    received = 0
+    while True:
+        query = {**params, 'pagenumber': page_number, 'pagesize': page_size} if page_size else params
+        response = api_get(f"{url}?{urlencode(query, safe=',')}")
+        if response.status_code != 200:
+            raise Exception(f"Error fetching {description}: {response.status_code}, {response.text}")
+        body = response.json()
+        items = body.get(key, [])
+        if page_number == 1 and body.get('count') is not None:
+            total = int(body['count'])
+        if page_size and items and items[0] == previous_first:
+            break
+        yield from items
+        received += len(items)
+        if not page_size or not items or len(items) > page_size or (total is not None and received >= total):
+            break
+        previous_first = items[0]
+        page_number += 1
+    if total is None and require_count:
+        raise Exception(f"Incomplete {description}: the server didn't report a count")
+    if total is not None and received != total:
+        raise Exception(f"Incomplete {description}: received {received} but the server reported {total}")
+
+# Second request: Function to get task-specific time details by contact. The category filter is sent to the API
+# and applied again in filter_time_records, for servers that ignore it
 def get_contact_task_details(contact_id, trackedfrom, trackedto):
-    url = f'{BASE_URL}/contacts/{contact_id}/time?trackedfrom={trackedfrom}&trackedto={trackedto}&fields=dates,project,task,notes,contact,category'
-    response = requests.get(url, headers=headers, auth=HTTPBasicAuth(USERNAME, PASSWORD))
+    params = {
+        'trackedfrom': trackedfrom,
+        'trackedto': trackedto,
+        'categories': ','.join(TIME_RECORD_CATEGORIES),
+        'fields': TIME_RECORD_FIELDS,
+    }
+    return list(iter_api_pages(f'{BASE_URL}/contacts/{contact_id}/time', params, 'timerecords', f"task details for contact {contact_id}"))
+
+# Light fetch of just the projects a contact has time records on, as a set of (project ID, project title)
+def get_contact_projects(contact_id, trackedfrom, trackedto):
+    params = {
+        'trackedfrom': trackedfrom,
+        'trackedto': trackedto,
+        'categories': ','.join(TIME_RECORD_CATEGORIES),
+        'fields': 'project',
+    }
+    records = iter_api_pages(f'{BASE_URL}/contacts/{contact_id}/time', params, 'timerecords', f"projects for contact {contact_id}")
+    return {(record['projectid'], record['projecttitle']) for record in records}
+
+# A contact's time records, through the local store when there is one (read straight from it when already synced)
+def get_contact_records(contact, trackedfrom, trackedto, store=None, synced=False):
+    if store:
+        if synced:
+            return store.contact_records(contact['id'], trackedfrom, trackedto)
+        return store.sync_contact(contact['id'], trackedfrom, trackedto)
+    return get_contact_task_details(contact['id'], trackedfrom, trackedto)
+
+# Fetch the time records for every contact in parallel, returned in the same order as the contacts
+def get_all_contact_task_details(contacts, trackedfrom, trackedto, max_workers=MAX_WORKERS, store=None):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        task_details = executor.map(lambda contact: get_contact_records(contact, trackedfrom, trackedto, store), contacts)
+        return list(zip(contacts, task_details))
+
+# Fetch stage of the streaming pipeline: yield (contact index, contact, time records) as each contact's fetch completes
+def iter_contact_task_details(contacts, trackedfrom, trackedto, max_workers=MAX_WORKERS, store=None, synced=False):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(get_contact_records, contact, trackedfrom, trackedto, store, synced): (index, contact)
+            for index, contact in enumerate(contacts)
+        }
+        for future in as_completed(futures):
+            index, contact = futures[future]
+            yield index, contact, future.result()
+
+# Fetch a project's invoices, or None if they couldn't be retrieved (retries are handled by the shared HTTP policy)
+def get_project_invoices(project_id):
+    url = f"{BASE_URL}/projects/{project_id}/invoices/"
+    try:
+        response = api_get(url)
+    except requests.exceptions.RequestException as e:
+        print(f"Network error for project {project_id}: {e}. Skipping project.")
+        return None
     if response.status_code == 200:
-        task_times = response.json()['timerecords']
-        filtered_records = [record for record in task_times if record['categoryname'] in ["On Hold", "Current Timed Projects"]]
-        return filtered_records
+        return response.json().get('invoices', [])
+    elif response.status_code in RETRY_STATUSES:
+        print(f"Failed to get invoices for project {project_id} after {MAX_RETRIES} retries ({response.status_code}). Skipping project.")
     else:
-        raise Exception(f"Error fetching task details for contact {contact_id}: {response.status_code}, {response.text}")
-
-def format_time(iso_time):
-    return pd.to_datetime(iso_time)
-
-# Function to calculate time spent between start and end times
-def calculate_time_spent(start_time, end_time):
-    start = pd.to_datetime(start_time)
-    end = pd.to_datetime(end_time)
-    time_spent = (end - start).total_seconds() / 60  # Time spent in minutes
-    # return format_time(time_spent)
-    return f"{int(time_spent // 60)}:{int(time_spent % 60):02d}"  # Return formatted HH:MM
-    
-def get_first_day_of_month_in_last_paid_invoice_date(project_id, max_retries=3, backoff_factor=2):
-    url = f"{BASE_URL}/projects/{project_id}/invoices/"
-    retries = 0
-    
-    while retries < max_retries:
-        try:
-            response = requests.get(url, headers=headers, auth=HTTPBasicAuth(USERNAME, PASSWORD))
-            if response.status_code == 200:
-                invoices = response.json().get('invoices', [])
-                # paid_invoices = [inv for inv in invoices if inv['status'] == 'paid']
-                if invoices:
-                    # Find the invoice with the latest date
-                    latest_invoice = max(invoices, key=lambda inv: inv['invoiceddate'])
-                    latest_invoiced_date = latest_invoice['invoiceddate']
-
-                    # Convert to datetime if it's a string
-                    if isinstance(latest_invoiced_date, str):
-                        latest_invoiced_date = datetime.strptime(latest_invoiced_date, "%Y-%m-%dT%H:%M:%S")
-
-                    # Set to the first day of the month
-                    first_day_of_month = latest_invoiced_date.replace(day=1)
+        # Client-side error (e.g., 404)
+        print(f"Client error {response.status_code} for project {project_id}: {response.text}")
+    return None
 
-                    # Format as 'YYYY-MM-DDTHH:MM:SS'
-                    formatted_date = first_day_of_month.strftime("%Y-%m-%dT%H:%M:%S")
+def get_first_day_of_month_in_last_paid_invoice_date(project_id, invoice_index=None):
+    invoice_index = invoice_index or InvoiceIndex({project_id: get_project_invoice_dates(project_id) or []})
+    # paid_invoices = [inv for inv in invoices if inv['status'] == 'paid']
+    latest_invoiced_date = invoice_index.last_invoice(project_id)
+    if latest_invoiced_date:
+        # Set to the first day of the month, formatted as 'YYYY-MM-DDTHH:MM:SS'
+        formatted_date = invoice_index.first_of_last_invoice_month(project_id).strftime("%Y-%m-%dT%H:%M:%S")
 
-                    print(f"Last paid invoice for project {project_id} found: {latest_invoiced_date} (adjusted to {formatted_date})")
-                    return formatted_date
+        print(f"Last paid invoice for project {project_id} found: {latest_invoiced_date} (adjusted to {formatted_date})")
+        return formatted_date
 
-                return None
-            elif response.status_code >= 500:
-                # Server error, so we should retry
-                retries += 1
-                wait_time = backoff_factor ** retries
-                print(f"Server error {response.status_code} for project {project_id}. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                # Client-side error (e.g., 404), don't retry
-                print(f"Client error {response.status_code} for project {project_id}: {response.text}")
-                return None
-        except requests.exceptions.RequestException as e:
-            # Catch network-related errors and retry
-            retries += 1
-            wait_time = backoff_factor ** retries
-            print(f"Network error for project {project_id}: {e}. Retrying in {wait_time} seconds...")
-            time.sleep(wait_time)
-    
-    # If retries are exhausted, log the failure and return None
-    print(f"Failed to get invoices for project {project_id} after {max_retries} retries. Skipping project.")
     return None
 
-def get_last_invoice_date(project_id, max_retries=3, backoff_factor=2):
-    url = f"{BASE_URL}/projects/{project_id}/invoices/"
-    retries = 0
+# Sorted invoiced dates of a project's invoices, or None if they couldn't be retrieved
+def get_project_invoice_dates(project_id):
+    invoices = get_project_invoices(project_id)
+    if invoices is None:
+        return None
+    return sorted(invoice['invoiceddate'] for invoice in invoices if invoice.get('invoiceddate'))
 
-    while retries < max_retries:
-        try:
-            response = requests.get(url, headers=headers, auth=HTTPBasicAuth(USERNAME, PASSWORD))
-            if response.status_code == 200:
-                invoices = response.json().get('invoices', [])
-                if invoices:
-                    # Find the invoice with the latest date
-                    latest_invoice = max(invoices, key=lambda inv: inv['invoiceddate'])
-                    latest_invoiced_date = latest_invoice['invoiceddate']
+def get_last_invoice_date(project_id, invoice_index=None):
+    invoice_index = invoice_index or InvoiceIndex({project_id: get_project_invoice_dates(project_id) or []})
+    next_day = invoice_index.day_after_last_invoice(project_id)
+    if next_day:
+        # Day after the latest invoice date
+        formatted_date = next_day.strftime("%Y-%m-%dT%H:%M:%S")
 
-                    # Convert to datetime if it's a string
-                    if isinstance(latest_invoiced_date, str):
-                        latest_invoiced_date = datetime.strptime(latest_invoiced_date, "%Y-%m-%dT%H:%M:%S")
+        print(f"Last invoice for project {project_id} found: {formatted_date} (day after latest invoice date)")
+        return formatted_date
 
-                    # Add one day to the latest invoice date
-                    next_day = latest_invoiced_date + timedelta(days=1)
-                    formatted_date = next_day.strftime("%Y-%m-%dT%H:%M:%S")
+    return None
 
-                    print(f"Last invoice for project {project_id} found: {formatted_date} (day after latest invoice date)")
-                    return formatted_date
+# Latest of a project's sorted invoiced dates that falls before `as_of` (of all of them when None), or None
+def last_invoice_before(dates, as_of=None):
+    if not dates:
+        return None
+    count = len(dates) if as_of is None else bisect.bisect_left(dates, as_of.strftime("%Y-%m-%dT%H:%M:%S"))
+    return datetime.strptime(dates[count - 1], "%Y-%m-%dT%H:%M:%S") if count else None
+
+# Invoiced dates of every project on the account, sorted per project, answering cutoff queries by binary search
+class InvoiceIndex:
+    # Project IDs are normalised to int however they are given, so lookups match the time records
+    def __init__(self, dates=None):
+        # project ID -> sorted invoiced dates
+        self.dates = {int(project_id): project_dates for project_id, project_dates in (dates or {}).items()}
+
+    # Build the index in one pass over an account-wide invoice listing. Invoices without a date, e.g. drafts,
+    # are left out, and project IDs are normalised before grouping so one project sent both ways stays one entry
+    @classmethod
+    def from_invoices(cls, invoices):
+        dates = {}
+        for invoice in invoices:
+            if invoice.get('invoiceddate'):
+                dates.setdefault(int(invoice['projectid']), []).append(invoice['invoiceddate'])
+        for project_dates in dates.values():
+            project_dates.sort()
+        return cls(dates)
+
+    # A project's sorted invoiced dates, empty if it has never been invoiced
+    def get(self, project_id):
+        return self.dates.get(int(project_id), [])
+
+    def last_invoice(self, project_id, as_of=None):
+        return last_invoice_before(self.get(project_id), as_of)
+
+    def day_after_last_invoice(self, project_id, as_of=None):
+        last_invoice = self.last_invoice(project_id, as_of)
+        return last_invoice + timedelta(days=1) if last_invoice else None
+
+    def first_of_last_invoice_month(self, project_id, as_of=None):
+        last_invoice = self.last_invoice(project_id, as_of)
+        return last_invoice.replace(day=1) if last_invoice else None
+
+# Index every invoice on the account from the paged account-wide listing. A project missing from the index
+# counts as never invoiced, so the listing must be complete: returns None if it can't be fetched or doesn't add
+# up to the count the server reports, and lookups fall back to one request per project
+def fetch_invoice_index():
+    try:
+        invoices = list(iter_api_pages(f'{BASE_URL}/invoices', {}, 'invoices', "invoices", require_count=True))
+        return InvoiceIndex.from_invoices(invoices)
+    except Exception as e:
+        print(f"Couldn't fetch the account-wide invoice listing ({e!r}). Falling back to per-project invoice requests.")
+        return None
+
+# Per-run cache of each project's invoice dates, keyed by project ID and shared across all contacts and report months
+class InvoiceDateCache:
+    def __init__(self, fetch=get_project_invoice_dates):
+        self.fetch = fetch
+        self.dates = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Return a project's sorted invoice dates, hitting the API only the first time it is seen
+    def get(self, project_id):
+        if project_id in self.dates:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.dates[project_id] = self.fetch(project_id)
+        return self.dates[project_id]
+
+    # Day after the project's last invoice, counting only invoices dated before `as_of` when given
+    def cutoff(self, project_id, as_of=None):
+        return self._cutoff(self.get(project_id), as_of)
+
+    @staticmethod
+    def _cutoff(dates, as_of=None):
+        last_invoice = last_invoice_before(dates, as_of)
+        return last_invoice + timedelta(days=1) if last_invoice else None
+
+    # Map a column of project IDs to their cutoffs, fetching any that haven't been seen yet
+    def map(self, project_ids, as_of=None):
+        misses = self.misses
+        unique_ids = project_ids.unique().tolist()
+        self.prefetch(unique_ids)
+        self.hits += len(project_ids) - (self.misses - misses)
+        return project_ids.map({project_id: self._cutoff(self.dates[project_id], as_of) for project_id in unique_ids})
+
+    # Look up the invoice dates for a batch of distinct project IDs up front, in parallel
+    def prefetch(self, project_ids, max_workers=MAX_WORKERS):
+        missing = [project_id for project_id in dict.fromkeys(project_ids) if project_id not in self.dates]
+        self.misses += len(missing)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for project_id, dates in zip(missing, executor.map(self.fetch, missing)):
+                self.dates[project_id] = dates
+
+    def summary(self):
+        return f"Invoice date cache: {len(self.dates)} projects, {self.hits} hits, {self.misses} misses"
+
+# On-disk store of time records, contacts and invoice dates, so later runs only fetch what changed
+class TimeRecordStore:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS contacts (
+                    id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS time_records (
+                    id INTEGER PRIMARY KEY,
+                    contact_id INTEGER NOT NULL,
+                    starttime TEXT NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS time_records_contact_start ON time_records (contact_id, starttime);
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    contact_id INTEGER PRIMARY KEY,
+                    synced_from TEXT NOT NULL,
+                    synced_to TEXT NOT NULL,
+                    synced_at TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS invoice_dates (
+                    project_id INTEGER PRIMARY KEY,
+                    dates TEXT,
+                    fetched_at TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS invoice_index (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    fetched_at TEXT NOT NULL
+                );
+            """)
+
+    def close(self):
+        self.conn.close()
+
+    def save_contacts(self, contacts):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO contacts (id, data) VALUES (?, ?)",
+                [(contact['id'], json.dumps(contact)) for contact in contacts],
+            )
 
+    # Work out which part of the requested window still has to come from the API
+    def _delta_from(self, contact_id, trackedfrom):
+        with self.lock:
+            state = self.conn.execute(
+                "SELECT synced_from, synced_to, synced_at FROM sync_state WHERE contact_id = ?", (contact_id,)
+            ).fetchone()
+        if state is None or state[0] > trackedfrom:
+            # Never synced, or the stored history doesn't reach back far enough
+            return trackedfrom, None
+        synced_from, synced_to, synced_at = state
+        last_sync = datetime.strptime(min(synced_to, synced_at[:10]), "%Y-%m-%d")
+        delta_from = (last_sync - timedelta(days=SYNC_OVERLAP_DAYS)).strftime("%Y-%m-%d")
+        return max(trackedfrom, delta_from), state
+
+    # Bring a contact's stored records up to date for the window, then return them
+    def sync_contact(self, contact_id, trackedfrom, trackedto):
+        self.sync(contact_id, trackedfrom, trackedto)
+        return self.contact_records(contact_id, trackedfrom, trackedto)
+
+    # Fetch only the part of the window the store doesn't already have fresh
+    def sync(self, contact_id, trackedfrom, trackedto):
+        fetch_from, state = self._delta_from(contact_id, trackedfrom)
+        if fetch_from <= trackedto:
+            records = get_contact_task_details(contact_id, fetch_from, trackedto)
+            synced_from = state[0] if state else fetch_from
+            synced_to = max(state[1], trackedto) if state else trackedto
+            with self.lock, self.conn:
+                # Replace the re-fetched window so records deleted upstream disappear too
+                self.conn.execute(
+                    "DELETE FROM time_records WHERE contact_id = ? AND substr(starttime, 1, 10) BETWEEN ? AND ?",
+                    (contact_id, fetch_from, trackedto),
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO time_records (id, contact_id, starttime, data) VALUES (?, ?, ?, ?)",
+                    [(record['id'], contact_id, record['starttime'], json.dumps(record)) for record in records],
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO sync_state (contact_id, synced_from, synced_to, synced_at) VALUES (?, ?, ?, ?)",
+                    (contact_id, synced_from, synced_to, datetime.now().strftime("%Y-%m-%dT%H:%M:%S")),
+                )
+
+    def contact_records(self, contact_id, trackedfrom, trackedto):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT data FROM time_records WHERE contact_id = ? AND substr(starttime, 1, 10) BETWEEN ? AND ? "
+                "ORDER BY starttime, id",
+                (contact_id, trackedfrom, trackedto),
+            ).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    # The stored projects a contact has time on in the included categories, as a set of (project ID, project title)
+    def contact_projects(self, contact_id, trackedfrom, trackedto):
+        categories = ', '.join('?' * len(TIME_RECORD_CATEGORIES))
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT json_extract(data, '$.projectid'), json_extract(data, '$.projecttitle') FROM time_records "
+                f"WHERE contact_id = ? AND substr(starttime, 1, 10) BETWEEN ? AND ? AND json_extract(data, '$.categoryname') IN ({categories})",
+                (contact_id, trackedfrom, trackedto, *TIME_RECORD_CATEGORIES),
+            ).fetchall()
+        return set(rows)
+
+    # Oldest fetch time of stored invoice dates that can be used without asking the API, or None when they are
+    # only a fallback for failed fetches (a TTL of 0, the default, as invoices are often raised just before a run)
+    @staticmethod
+    def _invoice_fresh_after():
+        if INVOICE_CUTOFF_TTL_HOURS <= 0:
+            return None
+        return (datetime.now() - timedelta(hours=INVOICE_CUTOFF_TTL_HOURS)).strftime("%Y-%m-%dT%H:%M:%S")
+
+    # A project's stored invoice dates fetched no earlier than `fetched_after` (of any age when None), or None
+    def stored_invoice_dates(self, project_id, fetched_after=None):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT dates FROM invoice_dates WHERE project_id = ? AND fetched_at >= ? AND dates IS NOT NULL",
+                (project_id, fetched_after or ''),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Wrap an invoice lookup so invoice dates fetched within the TTL are served from disk, and the last stored
+    # dates stand in when a fetch fails. Failed lookups (None) aren't stored, so they are retried on the next run
+    def cached_invoice_dates(self, fetch):
+        def lookup(project_id):
+            fresh_after = self._invoice_fresh_after()
+            dates = self.stored_invoice_dates(project_id, fresh_after) if fresh_after else None
+            if dates is not None:
+                return dates
+            dates = fetch(project_id)
+            if dates is None:
+                dates = self.stored_invoice_dates(project_id)
+                if dates is not None:
+                    print(f"Using the stored invoice dates for project {project_id} after a failed fetch.")
+                return dates
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO invoice_dates (project_id, dates, fetched_at) VALUES (?, ?, ?)",
+                    (project_id, json.dumps(dates), datetime.now().strftime("%Y-%m-%dT%H:%M:%S")),
+                )
+            return dates
+        return lookup
+
+    # The invoice index saved by an earlier run, or None if there isn't one within the invoice cutoff TTL
+    def load_invoice_index(self):
+        fresh_after = self._invoice_fresh_after()
+        if fresh_after is None:
+            return None
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM invoice_index WHERE fetched_at >= ?", (fresh_after,)).fetchone() is None:
                 return None
-            elif response.status_code >= 500:
-                retries += 1
-                wait_time = backoff_factor ** retries
-                print(f"Server error {response.status_code} for project {project_id}. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                print(f"Client error {response.status_code} for project {project_id}: {response.text}")
-                return None
-        except requests.exceptions.RequestException as e:
-            retries += 1
-            wait_time = backoff_factor ** retries
-            print(f"Network error for project {project_id}: {e}. Retrying in {wait_time} seconds...")
-            time.sleep(wait_time)
-
-    print(f"Failed to get invoices for project {project_id} after {max_retries} retries. Skipping project.")
-    return None
+            rows = self.conn.execute("SELECT project_id, dates FROM invoice_dates WHERE dates IS NOT NULL").fetchall()
+        return InvoiceIndex({project_id: json.loads(dates) for project_id, dates in rows})
+
+    # Replace the stored invoice dates with a freshly fetched index
+    def save_invoice_index(self, invoice_index):
+        fetched_at = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM invoice_dates")
+            self.conn.executemany(
+                "INSERT INTO invoice_dates (project_id, dates, fetched_at) VALUES (?, ?, ?)",
+                [(project_id, json.dumps(dates), fetched_at) for project_id, dates in invoice_index.dates.items()],
+            )
+            self.conn.execute("INSERT OR REPLACE INTO invoice_index (id, fetched_at) VALUES (1, ?)", (fetched_at,))
+
+# Invoice date lookups for a run: from the invoice index when PWF_INVOICE_INDEX is on and the account-wide
+# listing is available (reusing a stored copy only within PWF_INVOICE_CUTOFF_TTL_HOURS), otherwise one request
+# per project, which falls back to the stored dates for any project whose fetch fails
+def open_invoice_dates(store=None):
+    if INVOICE_INDEX:
+        invoice_index = store.load_invoice_index() if store else None
+        if invoice_index is None:
+            with stats.stage('invoice index'):
+                invoice_index = fetch_invoice_index()
+            if invoice_index is not None and store:
+                store.save_invoice_index(invoice_index)
+        if invoice_index is not None:
+            return InvoiceDateCache(invoice_index.get)
+    return InvoiceDateCache(store.cached_invoice_dates(get_project_invoice_dates) if store else get_project_invoice_dates)
+
+# Open the local store, or return None if it has been disabled
+def open_store(path=STORE_PATH):
+    # Recording or replaying the HTTP cache bypasses the store, so a replay makes exactly the recorded requests
+    if not path or HTTP_CACHE_MODE in ('record', 'replay'):
+        return None
+    return TimeRecordStore(path)
 
 # Calculate the start and end dates for the previous month
 def get_previous_month_dates():
@@ -163,176 +817,265 @@ def get_previous_month_dates():
     first_day_previous_month = datetime(last_day_previous_month.year, last_day_previous_month.month, 1)
     return first_day_previous_month, last_day_previous_month
 
-# Function to process both time totals and task details, including all records if a project has records in the previous month
-def process_time_per_contact(trackedfrom, trackedto):
-    staff_contacts = get_staff_contacts()
-    project_data_tasks = {}
-
-    # Get the date range for the previous month
-    prev_month_start, prev_month_end = get_previous_month_dates()
-    print(f"Including projects with time records from {prev_month_start.strftime('%b %d, %Y')} to {prev_month_end.strftime('%b %d, %Y')}...")
-
-    print("Calculating time per staff member...")
-
-    for contact in staff_contacts:
-        contact_id = contact['id']
-        contact_name = f"{contact['firstname']} {contact['lastname']}"
-
-        # Get task details per project for the specific contact
-        task_details = get_contact_task_details(contact_id, trackedfrom, trackedto)
-
-        # Dictionary to store time records for each project, used to determine if any records fall in the previous month
-        project_time_records = {}
-
-        # Process task details per project and remove entries with end_time before last paid invoice
-        for record in task_details:
-            project_id = record['projectid']
-            project_name = record['projecttitle']
-            project_number = record['projectnumber']
-
-            # Get the last invoice date for the project (actual date, not first of month)
-            last_invoice_date = get_last_invoice_date(project_id)
-            if last_invoice_date:
-                last_invoice_date = pd.to_datetime(last_invoice_date)
-            else:
-                last_invoice_date = pd.to_datetime(record['starttime'])
+# First day of the month `months` after the month containing `day`
+def add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+# First and last day of the month containing `day`
+def get_month_dates(day):
+    first_day = datetime(day.year, day.month, 1)
+    return first_day, add_months(first_day, 1) - timedelta(days=1)
+
+# Report months to produce, from a 'YYYY-MM' or 'YYYY-MM:YYYY-MM' range, defaulting to the previous month
+def get_report_months(report_months=REPORT_MONTHS):
+    if not report_months:
+        return [get_previous_month_dates()[0]]
+    first, _, last = report_months.partition(':')
+    month = datetime.strptime(first.strip(), '%Y-%m')
+    last_month = datetime.strptime((last or first).strip(), '%Y-%m')
+    if last_month < month:
+        raise Exception(f"PWF_REPORT_MONTHS '{report_months}' ends before it starts")
+    months = []
+    while month <= last_month:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+# Tracked window behind one report month: the month itself and the TRACKED_MONTHS - 1 months before it
+def get_tracked_window(month):
+    return add_months(month, 1 - TRACKED_MONTHS).strftime('%Y-%m-%d'), get_month_dates(month)[1].strftime('%Y-%m-%d')
+
+# Build one DataFrame holding every staff member's time records, in contact order
+def build_time_records_frame(contact_task_details):
+    records = []
+    staff = []
+    for contact, task_details in contact_task_details:
+        records.extend(task_details)
+        staff.extend([f"{contact['firstname']} {contact['lastname']}"] * len(task_details))
+    df = pd.DataFrame.from_records(records, columns=TIME_RECORD_COLUMNS)
+    df['Staff'] = staff
+    return df
+
+# Filter all time records in one columnar pass, keeping un-invoiced records for projects a staff member worked on
+# in the report month. With `as_of`, only invoices dated before it count towards the cutoff.
+def filter_time_records(df, invoice_dates, prev_month_start, prev_month_end, as_of=None):
+    df = df[df['categoryname'].isin(TIME_RECORD_CATEGORIES)]
+    start = pd.to_datetime(df['starttime'], format='ISO8601')
+    end = pd.to_datetime(df['endtime'], format='ISO8601')
+
+    # Remove entries with end_time before the day after the last invoice (records of never-invoiced projects are kept)
+    cutoff = pd.to_datetime(invoice_dates.map(df['projectid'], as_of)).fillna(start)
+    invoiced = end < cutoff
+    for project_name, count in df.loc[invoiced, 'projecttitle'].value_counts(sort=False).items():
+        print(f"Removing {count} task(s) for project '{project_name}' because their end time is before the last invoice date.")
+    df, start, end = df[~invoiced], start[~invoiced], end[~invoiced]
+
+    # Only include a staff member's records for a project if some of them fall within the previous month
+    in_prev_month = end.between(prev_month_start, prev_month_end)
+    active = in_prev_month.groupby([df['Staff'], df['projecttitle']], sort=False).transform('any')
+    for staff, project_name in df.loc[~active, ['Staff', 'projecttitle']].drop_duplicates().itertuples(index=False):
+        print(f"Skipping project '{project_name}' for {staff} as it has no time records in the report month.")
+    df, start, end = df[active], start[active], end[active]
+
+    # Typed records carried through to the writer: interned names, epoch seconds and time spent in whole minutes
+    return pd.DataFrame({
+        'project_name': df['projecttitle'].astype('category'),
+        'project_number': df['projectnumber'].astype('category'),
+        'task_name': df['taskname'].astype('category'),
+        'staff': df['Staff'].astype('category'),
+        'notes': df['notes'].fillna(''),
+        'start': start.dt.as_unit('s').astype('int64'),
+        'end': end.dt.as_unit('s').astype('int64'),
+        'minutes': ((end - start).dt.total_seconds() // 60).astype('int32'),
+    })
+
+# Join per-contact record frames for one project, re-interning the names across the parts
+def concat_records(parts):
+    records = pd.concat(parts, ignore_index=True)
+    for col in RECORD_CATEGORY_COLUMNS:
+        records[col] = records[col].astype('category')
+    return records
+
+# Records per project for one report month, from the part of the fetched records that falls in the month's tracked window
+def get_month_project_tasks(df, record_dates, invoice_dates, month, trackedfrom, trackedto, as_of_month_end=False):
+    month_start, month_end = get_month_dates(month)
+    window_from, window_to = get_tracked_window(month)
+    in_window = record_dates.between(max(window_from, trackedfrom), min(window_to, trackedto))
+    as_of = month_end + timedelta(days=1) if as_of_month_end else None
+
+    rows = filter_time_records(df[in_window], invoice_dates, month_start, month_end, as_of)
+    return {
+        project_name: project_rows.reset_index(drop=True)
+        for project_name, project_rows in rows.groupby('project_name', sort=False, observed=True)
+    }
 
-            # Check if the task's end_time is after the last invoice date
-            end_time = pd.to_datetime(record['endtime'])
-            if end_time < last_invoice_date:
-                print(f"Removing task '{record['taskname']}' for project '{project_name}' because its end time is before the last invoice date.")
-                continue
+# Function to process both time totals and task details for each report month, including all records if a project has
+# records in that month. The union of the months' tracked windows is fetched once and partitioned in memory.
+# With as_of_month_end, each month only counts invoices dated up to its last day, as it stood at the time.
+def process_time_per_contact(trackedfrom, trackedto, report_months, as_of_month_end=False):
+    with stats.stage('contact fetch'):
+        staff_contacts = get_staff_contacts()
+    store = open_store()
+    if store:
+        store.save_contacts(staff_contacts)
 
-            # Store the record in the project's time records
-            if project_name not in project_time_records:
-                project_time_records[project_name] = []
+    print(f"Fetching time records from {trackedfrom} to {trackedto}...")
 
-            project_time_records[project_name].append(record)
+    print("Calculating time per staff member...")
 
-        # Check if any time records for this project fall within the previous month
-        for project_name, records in project_time_records.items():
-            has_prev_month_records = any(
-                prev_month_start <= pd.to_datetime(record['endtime']) <= prev_month_end
-                for record in records
+    # Get task details per project for every contact before filtering, so the invoice lookups can be batched
+    with stats.stage('time fetch'):
+        contact_task_details = get_all_contact_task_details(staff_contacts, trackedfrom, trackedto, store=store)
+    with stats.stage('DataFrame build'):
+        df = build_time_records_frame(contact_task_details)
+        record_dates = df['starttime'].str[:10]
+
+    # Look up each project's invoice dates once for the whole run
+    invoice_dates = open_invoice_dates(store)
+    with stats.stage('invoice lookup'):
+        invoice_dates.prefetch(df.loc[df['categoryname'].isin(TIME_RECORD_CATEGORIES), 'projectid'].unique().tolist())
+
+    monthly_data_tasks = {}
+    for month in report_months:
+        month_start, month_end = get_month_dates(month)
+        print(f"Including projects with time records from {month_start.strftime('%b %d, %Y')} to {month_end.strftime('%b %d, %Y')}...")
+        with stats.stage('filtering'):
+            monthly_data_tasks[month] = get_month_project_tasks(
+                df, record_dates, invoice_dates, month, trackedfrom, trackedto, as_of_month_end
             )
 
-            # Only include this project if it has records in the previous month
-            if has_prev_month_records:
-                # Add all records (including older un-invoiced ones) for this project to project_data_tasks
-                for record in records:
-                    task_name = record['taskname']
-                    start_time = record['starttime']
-                    task_date = pd.to_datetime(start_time.split('T')[0]).strftime('%b %d, %Y')
-                    notes = record.get('notes', '')
-                    time_spent = calculate_time_spent(start_time, record['endtime'])
-                    formatted_start_time = format_time(start_time)
-                    formatted_end_time = format_time(record['endtime'])
-
-                    if project_name not in project_data_tasks:
-                        project_data_tasks[project_name] = []
-
-                    project_data_tasks[project_name].append({
-                        'Project Name': project_name,
-                        'Project Number': record['projectnumber'],
-                        'Task Name': task_name,
-                        'Task Date': task_date,
-                        'Staff': contact_name,
-                        'Time Record': notes,
-                        'Start': formatted_start_time,
-                        'Finish': formatted_end_time,
-                        'Time Spent': time_spent
-                    })
-            else:
-                print(f"Skipping project '{project_name}' as it has no time records in the previous month.")
-
-    return project_data_tasks
-
-# Define a function to add color formatting based on column names
-def color_headers(worksheet, header_row=2):
-    # Define the color mapping for each column name
-    color_mapping = {
-        "Project Name": "FFC9F8EA",  # Turquoise
-        "Project Number": "FFC9F8EA",  # Turquoise
-        "Task Name": "FFD7E2FF",  # Blue
-        "Task Date": "FFFEEFB8",  # Yellow
-        "Staff": "FFFEEFB8",  # Yellow
-        "Time Record": "FFFEEFB8",  # Yellow
-        "Start": "FFFEEFB8",  # Yellow
-        "Finish": "FFFEEFB8",  # Yellow
-        "Time Spent": "FFFEEFB8",  # Yellow
-    }
+    print(invoice_dates.summary())
+    if store:
+        store.close()
+    return monthly_data_tasks
+
+# Streaming variant of process_time_per_contact + export: records flow through fetch, filter and group stages one
+# contact at a time, and a project's workbooks are handed to the exporter as soon as every contact with time on it
+# (known from a light index pass) has been processed. Only projects still waiting on a contributor are held in memory.
+def stream_timesheets(trackedfrom, trackedto, report_months, exporter, as_of_month_end=False):
+    with stats.stage('contact fetch'):
+        staff_contacts = get_staff_contacts()
+    store = open_store()
+    if store:
+        store.save_contacts(staff_contacts)
+
+    # Index pass: which contacts have time on which projects. With a store, only the changes since the last
+    # sync come from the API and the projects are read from the synced records
+    def index_contact(contact):
+        if store:
+            store.sync(contact['id'], trackedfrom, trackedto)
+            return store.contact_projects(contact['id'], trackedfrom, trackedto)
+        return get_contact_projects(contact['id'], trackedfrom, trackedto)
+
+    print(f"Indexing projects with time records from {trackedfrom} to {trackedto}...")
+    with stats.stage('project index'), ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        contact_projects = dict(zip([contact['id'] for contact in staff_contacts], executor.map(index_contact, staff_contacts)))
+    contributors = {}
+    for contact_id, projects in contact_projects.items():
+        for _, project_name in projects:
+            contributors.setdefault(project_name, set()).add(contact_id)
+
+    invoice_dates = open_invoice_dates(store)
+    with stats.stage('invoice lookup'):
+        invoice_dates.prefetch(project_id for projects in contact_projects.values() for project_id, _ in projects)
+
+    # Hand a project's rows for every report month to the exporter, in contact order, and release them
+    def flush(project_name):
+        for month in report_months:
+            parts = pending.pop((month, project_name), None)
+            if parts:
+                records = concat_records([rows for _, rows in sorted(parts, key=lambda part: part[0])])
+                output_dir = f"{OUTPUT_DIR}/{month.strftime('%B %Y')}"
+                os.makedirs(output_dir, exist_ok=True)
+                exporter.submit(output_dir, project_name, records, add_months(month, 1).strftime('%b %Y'), month)
+
+    pending = {}  # (report month, project name) -> [(contact index, rows)]
+    for index, contact, task_details in iter_contact_task_details(staff_contacts, trackedfrom, trackedto, store=store, synced=True):
+        # Filter stage: this contact's records, for each report month
+        with stats.stage('filtering'):
+            df = build_time_records_frame([(contact, task_details)])
+            record_dates = df['starttime'].str[:10]
+            for month in report_months:
+                month_tasks = get_month_project_tasks(df, record_dates, invoice_dates, month, trackedfrom, trackedto, as_of_month_end)
+                for project_name, rows in month_tasks.items():
+                    pending.setdefault((month, project_name), []).append((index, rows))
+
+        # Group stage: a project is complete once its last contributor is in
+        for _, project_name in contact_projects[contact['id']]:
+            waiting = contributors.get(project_name)
+            if waiting is not None:
+                waiting.discard(contact['id'])
+                if not waiting:
+                    del contributors[project_name]
+                    flush(project_name)
+
+    # Anything the index didn't know about, e.g. time added between the two passes
+    for month, project_name in list(pending):
+        flush(project_name)
+
+    print(invoice_dates.summary())
+    if store:
+        store.close()
+
+# Header color for each column name
+HEADER_COLORS = {
+    "Project Name": "FFC9F8EA",  # Turquoise
+    "Project Number": "FFC9F8EA",  # Turquoise
+    "Task Name": "FFD7E2FF",  # Blue
+    "Task Date": "FFFEEFB8",  # Yellow
+    "Staff": "FFFEEFB8",  # Yellow
+    "Time Record": "FFFEEFB8",  # Yellow
+    "Start": "FFFEEFB8",  # Yellow
+    "Finish": "FFFEEFB8",  # Yellow
+    "Time Spent": "FFFEEFB8",  # Yellow
+}
 
-    # Iterate over each cell in the header row and apply the color
-    for col_idx, cell in enumerate(worksheet[header_row], start=1):
-        column_name = cell.value
-        color = color_mapping.get(column_name)
-        if color:
-            fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
-            bold_font = Font(bold=True)
-            cell.fill = fill
-            cell.font = bold_font
-    
-    # Create a bold font object
-    bold_font = Font(bold=True)
-
-    # Iterate over each cell in the header row and apply the color and bold font
-    for col_idx, cell in enumerate(worksheet[header_row], start=1):
-        column_name = cell.value
-        color = color_mapping.get(column_name)
-        if color:
+# Grouped header row: title, the columns it spans and its color
+GROUPED_HEADERS = [
+    ("PROJECT", ["Project Name"], "FFC9F8EA"),  # Turquoise
+    ("TASK", ["Task Name"], "FFD7E2FF"),  # Blue
+    ("TIME RECORD", ["Task Date", "Staff", "Time Record", "Start", "Finish", "Time Spent"], "FFFEEFB8"),  # Yellow
+]
+
+DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'  # Number format of the Start and Finish columns
+DURATION_FORMAT = '[h]:mm:ss'  # Number format of the Time Spent column
+COLUMN_STYLES = {'Start': 'datetime', 'Finish': 'datetime', 'Time Spent': 'duration'}  # Task detail columns not in the body style
+
+_timesheet_styles = None
+
+# Named styles for the openpyxl engine, created once per run and registered with every workbook written.
+# Keyed 'body', 'datetime', 'duration', ('header', color) and ('group', color)
+def get_timesheet_styles(font_name="Calibri", font_size=10):
+    global _timesheet_styles
+    if _timesheet_styles is None:
+        font = Font(name=font_name, size=font_size)
+        bold_font = Font(name=font_name, size=font_size, bold=True)
+        styles = {
+            'body': NamedStyle('Timesheet Body', font=font),
+            'datetime': NamedStyle('Timesheet Datetime', font=font, number_format=DATETIME_FORMAT),
+            'duration': NamedStyle('Timesheet Duration', font=font, number_format=DURATION_FORMAT),
+        }
+        for color in sorted(set(HEADER_COLORS.values())):
             fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
-            cell.fill = fill
-        cell.font = bold_font  # Apply the bold font to the cell
-
-# Define a function to set the font for the entire worksheet
-def set_font(worksheet, font_name="Calibri", font_size=10):
-    font = Font(name=font_name, size=font_size)
-    for row in worksheet.iter_rows():
-        for cell in row:
-            cell.font = font
+            styles[('header', color)] = NamedStyle(f'Timesheet Header {color}', font=bold_font, fill=fill)
+            styles[('group', color)] = NamedStyle(
+                f'Timesheet Group {color}', font=bold_font, fill=fill,
+                alignment=Alignment(horizontal='center', vertical='center'),
+            )
+        _timesheet_styles = styles
+    return _timesheet_styles
 
 # Function to add the grouped header row
-def add_grouped_headers(worksheet):
-    # Define the column ranges for each group
-    project_columns = ["Project Name"]
-    task_columns = ["Task Name"]
-    time_record_columns = ["Task Date", "Staff", "Time Record", "Start", "Finish", "Time Spent"]
-
-    # Get the column letters for each group
-    project_start = get_column_letter(1)
-    project_end = get_column_letter(len(project_columns))
-    task_start = get_column_letter(len(project_columns) + 1)
-    task_end = get_column_letter(len(project_columns) + len(task_columns))
-    time_record_start = get_column_letter(len(project_columns) + len(task_columns) + 1)
-    time_record_end = get_column_letter(len(project_columns) + len(task_columns) + len(time_record_columns))
-
-    # Define fills and fonts for each group header
-    project_fill = PatternFill(start_color="FFC9F8EA", end_color="FFC9F8EA", fill_type="solid")  # Turquoise
-    task_fill = PatternFill(start_color="FFD7E2FF", end_color="FFD7E2FF", fill_type="solid")  # Blue
-    time_record_fill = PatternFill(start_color="FFFEEFB8", end_color="FFFEEFB8", fill_type="solid")  # Yellow
-    bold_font = Font(bold=True)
-
-    # Merge cells for each group, set their titles, apply alignment, fill, and bold font
-    worksheet.merge_cells(f"{project_start}1:{project_end}1")
-    project_cell = worksheet[f"{project_start}1"]
-    project_cell.value = "PROJECT"
-    project_cell.alignment = Alignment(horizontal='center', vertical='center')
-    project_cell.fill = project_fill
-    project_cell.font = bold_font
-
-    worksheet.merge_cells(f"{task_start}1:{task_end}1")
-    task_cell = worksheet[f"{task_start}1"]
-    task_cell.value = "TASK"
-    task_cell.alignment = Alignment(horizontal='center', vertical='center')
-    task_cell.fill = task_fill
-    task_cell.font = bold_font
-
-    worksheet.merge_cells(f"{time_record_start}1:{time_record_end}1")
-    time_record_cell = worksheet[f"{time_record_start}1"]
-    time_record_cell.value = "TIME RECORD"
-    time_record_cell.alignment = Alignment(horizontal='center', vertical='center')
-    time_record_cell.fill = time_record_fill
-    time_record_cell.font = bold_font
+def add_grouped_headers(worksheet, styles):
+    # Merge cells for each group and set their titles in the group style
+    first_col = 1
+    for title, columns, color in GROUPED_HEADERS:
+        last_col = first_col + len(columns) - 1
+        if last_col > first_col:
+            worksheet.merge_cells(start_row=1, start_column=first_col, end_row=1, end_column=last_col)
+        worksheet.cell(row=1, column=first_col, value=title).style = styles[('group', color)].name
+        first_col = last_col + 1
 
 # Function to hide specific columns in the worksheet
 def hide_columns(worksheet, columns_to_hide):
@@ -343,91 +1086,435 @@ def hide_columns(worksheet, columns_to_hide):
                 worksheet.column_dimensions[get_column_letter(col_idx)].width = 0
                 break
 
+# Width of each task details column, sized to fit its longest value plus a little padding
+def column_widths(df_tasks):
+    return [max(df_tasks[col].astype(str).map(len).max(), len(col)) + 2 for col in df_tasks.columns]
+
+# Cells below the task details, keyed by (row, column): the pivot table title, one row per staff member and the total
+def summary_cells(df_tasks, pivot_df, total_time_formatted):
+    last_row = len(df_tasks) + 3  # Add 3 for the extra row and header
+    cells = {(last_row + 1, 1): "Total Time Per Staff"}
+
+    # Write the pivot table below the task details, starting from the title
+    for r_idx, row in pivot_df.iterrows():
+        for c_idx, value in enumerate(row):
+            cells[(last_row + r_idx + 2, c_idx + 1)] = value
+
+    # Add the total sum below the pivot table
+    total_label_row = last_row + len(pivot_df)
+    cells[(total_label_row, 7)] = "TOTAL:"
+    cells[(total_label_row, 8)] = total_time_formatted
+    return cells
+
+# Every (row, column, value) of the summary area, with None for the gaps so each cell can carry the sheet font
+def summary_area(df_tasks, pivot_df, total_time_formatted):
+    cells = summary_cells(df_tasks, pivot_df, total_time_formatted)
+    last_col = max(len(df_tasks.columns), max(column for _, column in cells))
+    for row in range(len(df_tasks) + 3, max(row for row, _ in cells) + 1):
+        for column in range(1, last_col + 1):
+            yield row, column, cells.get((row, column))
+
+# A new openpyxl workbook with the shared named styles registered and no sheets
+def new_timesheet_workbook():
+    workbook = openpyxl.Workbook()
+    for style in get_timesheet_styles().values():
+        workbook.add_named_style(style)
+    workbook.remove(workbook.active)
+    return workbook
+
+# Write a project's timesheet with openpyxl
+def write_timesheet_openpyxl(excel_file, df_tasks, pivot_df, total_time_formatted):
+    workbook = new_timesheet_workbook()
+    write_timesheet_sheet_openpyxl(workbook.create_sheet('Task Details'), df_tasks, pivot_df, total_time_formatted)
+    workbook.save(excel_file)
+
+# Fill an openpyxl worksheet with a project's timesheet, styling each cell with the shared named styles as it is written
+def write_timesheet_sheet_openpyxl(worksheet, df_tasks, pivot_df, total_time_formatted):
+    styles = get_timesheet_styles()
+    body_style = styles['body'].name
+
+    # Grouped headers in the first row, column headers in the second
+    add_grouped_headers(worksheet, styles)
+    for col_idx, col in enumerate(df_tasks.columns, 1):
+        header_style = styles[('header', HEADER_COLORS[col])].name if col in HEADER_COLORS else body_style
+        worksheet.cell(row=2, column=col_idx, value=col).style = header_style
+
+    # Task details, with start and finish as datetimes and time spent as a duration
+    column_styles = [styles[COLUMN_STYLES.get(col, 'body')].name for col in df_tasks.columns]
+    time_spent_idx = df_tasks.columns.get_loc('Time Spent')
+    for row_idx, values in enumerate(df_tasks.itertuples(index=False), start=3):
+        for col_idx, value in enumerate(values):
+            if col_idx == time_spent_idx:
+                value = timedelta(minutes=int(value))
+            elif isinstance(value, pd.Timestamp):
+                value = value.to_pydatetime()
+            elif value == '':
+                value = None
+            worksheet.cell(row=row_idx, column=col_idx + 1, value=value).style = column_styles[col_idx]
+
+    # Pivot table and total below the task details
+    for row, column, value in summary_area(df_tasks, pivot_df, total_time_formatted):
+        worksheet.cell(row=row, column=column, value=value).style = body_style
+
+    # Adjust the width of each column to fit the content
+    for col_idx, width in enumerate(column_widths(df_tasks), 1):
+        worksheet.column_dimensions[get_column_letter(col_idx)].width = width
+
+# Write a project's timesheet row by row with xlsxwriter, applying shared formats as each cell is emitted
+def write_timesheet_xlsxwriter(excel_file, df_tasks, pivot_df, total_time_formatted, font_name="Calibri", font_size=10):
+    if xlsxwriter is None:
+        raise Exception("PWF_EXCEL_ENGINE=xlsxwriter requires the xlsxwriter package (pip install xlsxwriter)")
+
+    workbook = xlsxwriter.Workbook(excel_file, {'constant_memory': True})
+    formats = timesheet_formats(workbook, font_name, font_size)
+    write_timesheet_sheet_xlsxwriter(workbook.add_worksheet('Task Details'), formats, df_tasks, pivot_df, total_time_formatted)
+    workbook.close()
+
+# Formats are created once per workbook and shared by every cell that uses them, keyed like the openpyxl named styles
+def timesheet_formats(workbook, font_name="Calibri", font_size=10):
+    font = {'font_name': font_name, 'font_size': font_size}
+    formats = {
+        'body': workbook.add_format(font),
+        'datetime': workbook.add_format({**font, 'num_format': DATETIME_FORMAT}),
+        'duration': workbook.add_format({**font, 'num_format': DURATION_FORMAT}),
+    }
+    for color in set(HEADER_COLORS.values()):
+        fill = {'pattern': 1, 'bg_color': f'#{color[2:]}'}
+        formats[('header', color)] = workbook.add_format({**font, **fill, 'bold': True})
+        formats[('group', color)] = workbook.add_format({**font, **fill, 'bold': True, 'align': 'center', 'valign': 'vcenter'})
+    return formats
+
+# Fill an xlsxwriter worksheet with a project's timesheet row by row, applying the shared formats as each cell is emitted
+def write_timesheet_sheet_xlsxwriter(worksheet, formats, df_tasks, pivot_df, total_time_formatted):
+    cell_format = formats['body']
+
+    # xlsxwriter pads widths the way Excel's column dialog does, so take the padding off to match the openpyxl engine
+    for col_idx, width in enumerate(column_widths(df_tasks)):
+        worksheet.set_column(col_idx, col_idx, width - 5 / 7)
+
+    # Grouped headers in the first row, column headers in the second
+    first_col = 0
+    for title, columns, color in GROUPED_HEADERS:
+        last_col = first_col + len(columns) - 1
+        if last_col > first_col:
+            worksheet.merge_range(0, first_col, 0, last_col, title, formats[('group', color)])
+        else:
+            worksheet.write_string(0, first_col, title, formats[('group', color)])
+        first_col = last_col + 1
+    for col_idx, col in enumerate(df_tasks.columns):
+        worksheet.write_string(1, col_idx, col, formats[('header', HEADER_COLORS[col])] if col in HEADER_COLORS else cell_format)
+
+    # Task details, with start and finish as datetimes and time spent as a duration
+    column_formats = [formats[COLUMN_STYLES.get(col, 'body')] for col in df_tasks.columns]
+    time_spent_idx = df_tasks.columns.get_loc('Time Spent')
+    for row_idx, values in enumerate(df_tasks.itertuples(index=False), start=2):
+        for col_idx, value in enumerate(values):
+            if col_idx == time_spent_idx:
+                worksheet.write_datetime(row_idx, col_idx, timedelta(minutes=int(value)), column_formats[col_idx])
+            elif value is None or value == '' or (isinstance(value, float) and pd.isna(value)):
+                worksheet.write_blank(row_idx, col_idx, None, column_formats[col_idx])
+            elif isinstance(value, pd.Timestamp):
+                worksheet.write_datetime(row_idx, col_idx, value.to_pydatetime(), column_formats[col_idx])
+            else:
+                worksheet.write(row_idx, col_idx, value, column_formats[col_idx])
+
+    # Pivot table and total below the task details
+    for row, column, value in summary_area(df_tasks, pivot_df, total_time_formatted):
+        if value is None:
+            worksheet.write_blank(row - 1, column - 1, None, cell_format)
+        else:
+            worksheet.write(row - 1, column - 1, value, cell_format)
+
+# Build one project's timesheet and write it to its own Excel file, returning the file name
+def export_project_timesheet(output_dir, project_name, records, formatted_date):
+    with stats.stage('DataFrame build'):
+        df_tasks, pivot_df, total_time_formatted = build_timesheet_frames(records)
+
+    # Replace invalid characters in project names that can't be used in file names
+    safe_project_name = "".join([c if c.isalnum() or c in (' ', '-', '_') else '_' for c in project_name])
+    project_number = records['project_number'].iloc[0]
+    excel_file = f'{output_dir}/{project_number} - {safe_project_name} {formatted_date} Timesheet.xlsx'
+
+    # Write the task details, pivot table and total with the configured engine
+    with stats.stage('Excel write'):
+        if EXCEL_ENGINE == 'xlsxwriter':
+            write_timesheet_xlsxwriter(excel_file, df_tasks, pivot_df, total_time_formatted)
+        else:
+            write_timesheet_openpyxl(excel_file, df_tasks, pivot_df, total_time_formatted)
+    return excel_file
+
+# Runs in an export worker process: write one project with fresh stats and hand the stage timings back
+def export_project_timesheet_in_worker(output_dir, project_name, records, formatted_date):
+    global stats
+    stats = RunStats()
+    excel_file = export_project_timesheet(output_dir, project_name, records, formatted_date)
+    return excel_file, stats.stages
+
+# Format a number of minutes as H:MM
+def format_minutes(minutes):
+    return f"{int(minutes) // 60}:{int(minutes) % 60:02d}"
+
+# Task details, per-staff pivot table and formatted total for one project's records
+def build_timesheet_frames(records):
+    start = pd.to_datetime(records['start'], unit='s')
+    df_tasks = pd.DataFrame({
+        'Project Name': records['project_name'].astype(str),
+        'Task Name': records['task_name'].astype(str),
+        'Task Date': start.dt.strftime('%b %d, %Y'),
+        'Staff': records['staff'].astype(str),
+        'Time Record': records['notes'],
+        'Start': start,
+        'Finish': pd.to_datetime(records['end'], unit='s'),
+        'Time Spent': records['minutes'],  # Whole minutes, written to Excel as a duration
+    })
+
+    # Total time spent by each staff member, and for the whole project
+    pivot_df, total_time_formatted = build_staff_pivot(df_tasks.groupby('Staff')['Time Spent'].sum())
+    return df_tasks, pivot_df, total_time_formatted
+
+# Pivot table of time spent per staff member and the formatted total, from minutes indexed by staff name
+def build_staff_pivot(staff_minutes):
+    pivot_df = pd.DataFrame({
+        'Staff': staff_minutes.index,
+        'Total Time Spent (HH:MM)': [format_minutes(minutes) for minutes in staff_minutes],
+    })
+    return pivot_df, format_minutes(staff_minutes.sum())
+
+# Index sheet columns of the consolidated workbook, with their header colors
+INDEX_HEADERS = [
+    ("Project Number", "FFC9F8EA"),  # Turquoise
+    ("Project Name", "FFC9F8EA"),  # Turquoise
+    ("Staff Count", "FFFEEFB8"),  # Yellow
+    ("Total Time Spent (HH:MM)", "FFFEEFB8"),  # Yellow
+]
+
+# Unique, valid Excel sheet names for the projects, from their number and name
+def project_sheet_names(project_data_tasks, reserved=('Index',)):
+    used = {name.lower() for name in reserved}
+    sheet_names = []
+    for project_name, records in project_data_tasks.items():
+        base = re.sub(r"[\[\]:*?/\\]", '_', f"{records['project_number'].iloc[0]} {project_name}").strip("' ")
+        sheet_name = base[:31]
+        suffix = 2
+        while sheet_name.lower() in used:
+            sheet_name = f"{base[:31 - len(str(suffix)) - 3]} ({suffix})"
+            suffix += 1
+        used.add(sheet_name.lower())
+        sheet_names.append(sheet_name)
+    return sheet_names
+
+# Write every project's timesheet for one report month into a single workbook with the configured engine:
+# an index sheet listing each project's total and linking to its sheet, then one sheet per project.
+# Returns the file name.
+def export_consolidated_workbook(project_data_tasks, output_dir, formatted_date):
+    excel_file = f'{output_dir}/All Projects {formatted_date} Timesheets.xlsx'
+    if EXCEL_ENGINE == 'xlsxwriter':
+        if xlsxwriter is None:
+            raise Exception("PWF_EXCEL_ENGINE=xlsxwriter requires the xlsxwriter package (pip install xlsxwriter)")
+        workbook = xlsxwriter.Workbook(excel_file, {'constant_memory': True})
+        formats = timesheet_formats(workbook)
+        index_sheet = workbook.add_worksheet('Index')
+    else:
+        workbook = new_timesheet_workbook()
+        index_sheet = workbook.create_sheet('Index')
+
+    # One sheet per project, in the same layout as the per-project files
+    index_rows = []  # (sheet name, [project number, project name, staff count, total])
+    for (project_name, records), sheet_name in zip(project_data_tasks.items(), project_sheet_names(project_data_tasks)):
+        with stats.stage('DataFrame build'):
+            df_tasks, pivot_df, total_time_formatted = build_timesheet_frames(records)
+        with stats.stage('Excel write'):
+            if EXCEL_ENGINE == 'xlsxwriter':
+                write_timesheet_sheet_xlsxwriter(workbook.add_worksheet(sheet_name), formats, df_tasks, pivot_df, total_time_formatted)
+            else:
+                write_timesheet_sheet_openpyxl(workbook.create_sheet(sheet_name), df_tasks, pivot_df, total_time_formatted)
+        index_rows.append((sheet_name, [records['project_number'].iloc[0], project_name, len(pivot_df), total_time_formatted]))
+
+    # Index of the projects, each name linking to its sheet
+    with stats.stage('Excel write'):
+        widths = [
+            max([len(title)] + [len(str(values[col_idx])) for _, values in index_rows]) + 2
+            for col_idx, (title, _) in enumerate(INDEX_HEADERS)
+        ]
+        if EXCEL_ENGINE == 'xlsxwriter':
+            for col_idx, ((title, color), width) in enumerate(zip(INDEX_HEADERS, widths)):
+                index_sheet.set_column(col_idx, col_idx, width - 5 / 7)
+                index_sheet.write_string(0, col_idx, title, formats[('header', color)])
+            for row_idx, (sheet_name, values) in enumerate(index_rows, start=1):
+                for col_idx, value in enumerate(values):
+                    if col_idx == 1:
+                        index_sheet.write_url(row_idx, col_idx, f"internal:'{sheet_name}'!A1", formats['body'], string=value)
+                    else:
+                        index_sheet.write(row_idx, col_idx, value, formats['body'])
+            workbook.close()
+        else:
+            styles = get_timesheet_styles()
+            for col_idx, ((title, color), width) in enumerate(zip(INDEX_HEADERS, widths), 1):
+                index_sheet.column_dimensions[get_column_letter(col_idx)].width = width
+                index_sheet.cell(row=1, column=col_idx, value=title).style = styles[('header', color)].name
+            for row_idx, (sheet_name, values) in enumerate(index_rows, start=2):
+                for col_idx, value in enumerate(values, 1):
+                    index_sheet.cell(row=row_idx, column=col_idx, value=value).style = styles['body'].name
+                index_sheet.cell(row=row_idx, column=2).hyperlink = Hyperlink(ref=f"B{row_idx}", location=f"'{sheet_name}'!A1")
+            workbook.save(excel_file)
+    return excel_file
+
+# Write one report month's filtered records, and the per-staff totals of each project, as Parquet or CSV files.
+# Returns the file names.
+def export_records(project_data_tasks, output_dir, formatted_date, file_format):
+    if file_format == 'parquet' and pyarrow is None:
+        raise Exception("PWF_OUTPUT_MODE=parquet requires the pyarrow package (pip install pyarrow)")
+    records = concat_records(list(project_data_tasks.values())) if project_data_tasks else pd.DataFrame(columns=RECORD_COLUMNS)
+    records['start'] = pd.to_datetime(records['start'], unit='s')
+    records['end'] = pd.to_datetime(records['end'], unit='s')
+
+    # Per-staff totals for each project, with the same pivot and total as the timesheets plus a TOTAL row
+    totals = []
+    for project_name, project_records in project_data_tasks.items():
+        staff_minutes = project_records.groupby(project_records['staff'].astype(str))['minutes'].sum()
+        pivot_df, total_time_formatted = build_staff_pivot(staff_minutes)
+        totals.append(pd.DataFrame({
+            'project_number': project_records['project_number'].iloc[0],
+            'project_name': project_name,
+            'staff': list(pivot_df['Staff']) + ['TOTAL'],
+            'minutes': list(staff_minutes) + [staff_minutes.sum()],
+            'time_spent': list(pivot_df['Total Time Spent (HH:MM)']) + [total_time_formatted],
+        }))
+    totals = pd.concat(totals, ignore_index=True) if totals else pd.DataFrame(columns=['project_number', 'project_name', 'staff', 'minutes', 'time_spent'])
+
+    files = []
+    for frame, name in [(records, 'Time Records'), (totals, 'Staff Totals')]:
+        path = f'{output_dir}/All Projects {formatted_date} {name}.{file_format}'
+        if file_format == 'parquet':
+            frame.to_parquet(path, index=False)
+        else:
+            frame.to_csv(path, index=False)
+        files.append(path)
+    return files
+
+# Writes timesheets as they are handed over, in parallel worker processes when more than one is configured.
+# A failing project is reported and skipped so it doesn't stop the others; finish() returns the failures.
+class TimesheetExporter:
+    def __init__(self, workers=EXPORT_WORKERS):
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        if self.executor is not None:
+            # Start the worker processes now, before the streaming fetch threads exist, so none is forked mid-request
+            self.executor.submit(int).result()
+        self.futures = []
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    # Queue one project's workbook; file names carry formatted_date, the month it is issued in (e.g. 'Sep 2025')
+    def submit(self, output_dir, project_name, records, formatted_date, month=None):
+        label = f"{project_name} ({month.strftime('%b %Y')})" if month else project_name
+        if self.executor is None:
+            self._report(project_name, label, lambda: export_project_timesheet(output_dir, project_name, records, formatted_date))
+            return
+        future = self.executor.submit(export_project_timesheet_in_worker, output_dir, project_name, records, formatted_date)
+        future.add_done_callback(lambda future: self._report(project_name, label, lambda: self._collect(future.result())))
+        self.futures.append(future)
+
+    # Wait for every queued workbook and return the failures, keyed by project (and month when given)
+    def finish(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        return self.failures
+
+    def _collect(self, result):
+        excel_file, worker_stages = result
+        stats.add_stages(worker_stages)
+        return excel_file
+
+    def _report(self, project_name, label, result):
+        try:
+            excel_file = result()
+        except Exception as e:
+            print(f"Failed to write timesheet for project '{project_name}': {e!r}")
+            with self.lock:
+                self.failures[label] = e
+        else:
+            print(f"Time data and pivot table for project '{project_name}' saved to {excel_file}")
+
+# Write every project's timesheet for one report month and return the failures by project name
+def export_timesheets(project_data_tasks, output_dir, formatted_date, workers=EXPORT_WORKERS):
+    exporter = TimesheetExporter(workers if len(project_data_tasks) > 1 else 1)
+    for project_name, records in project_data_tasks.items():
+        exporter.submit(output_dir, project_name, records, formatted_date)
+    return exporter.finish()
+
+# Print the run report and, if PWF_REPORT_JSON is set, save it as JSON
+def print_run_report(report_json=REPORT_JSON):
+    concurrency = http_policy.concurrency
+    print(stats.summary())
+    print(f"  API concurrency limit: {int(concurrency.limit)} at the end of the run, lowest {concurrency.lowest}")
+    if report_json:
+        report = stats.as_dict()
+        report['concurrency_limit'] = {'final': int(concurrency.limit), 'lowest': concurrency.lowest}
+        with open(report_json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Run report saved to {report_json}")
+
 # Main function to write separate Excel files per project
 def main():
-    # Process time for all staff contacts
-    project_data_tasks = process_time_per_contact(trackedfrom, trackedto)
-
-    # Create output directory if it doesn't exist
-    output_dir = 'output/projects/August 2025'
-    os.makedirs(output_dir, exist_ok=True)
-
-        # Write each project's data to a separate Excel file
-    for project_name, records in project_data_tasks.items():
-        df_tasks = pd.DataFrame(project_data_tasks.get(project_name, []))  # Get task details, if available
-
-        # Replace invalid characters in project names that can't be used in file names
-        safe_project_name = "".join([c if c.isalnum() or c in (' ', '-', '_') else '_' for c in project_name])
-        formatted_date = datetime.now().strftime('%b %Y')
-        project_number = records[0]['Project Number']
-        df_tasks.drop(columns=['Project Number'], inplace=True, errors='ignore')
-        excel_file = f'{output_dir}/{project_number} - {safe_project_name} {formatted_date} Timesheet.xlsx'
-
-        # Convert "Time Spent" from "HH:MM" string to Excel duration (fraction of a day)
-        df_tasks['Time Spent'] = df_tasks['Time Spent'].apply(lambda x: int(x.split(':')[0]) * 60 + int(x.split(':')[1]))  # minutes
-        df_tasks['Time Spent'] = df_tasks['Time Spent'] / 1440  # convert to Excel duration
-
-        # Create pivot table for total time spent by each staff member
-        df_tasks['Time Spent in Minutes'] = df_tasks['Time Spent'] * 1440
-        pivot_df = df_tasks.pivot_table(index='Staff', values='Time Spent in Minutes', aggfunc='sum').reset_index()
-        pivot_df['Total Time Spent (HH:MM)'] = pivot_df['Time Spent in Minutes'].apply(lambda x: f"{int(x)//60}:{int(x)%60:02d}")
-        pivot_df = pivot_df[['Staff', 'Total Time Spent (HH:MM)']]
-        df_tasks.drop(columns=['Time Spent in Minutes'], inplace=True)
-
-        total_time_minutes = pivot_df['Total Time Spent (HH:MM)'].apply(lambda x: int(x.split(':')[0]) * 60 + int(x.split(':')[1])).sum()
-        total_time_formatted = f"{total_time_minutes // 60}:{total_time_minutes % 60:02d}"
-
-        # Write DataFrame to Excel
-        with pd.ExcelWriter(excel_file, engine='openpyxl') as writer:
-            df_tasks.to_excel(writer, sheet_name='Task Details', index=False, startrow=1)  # Shift down by 1 row
-
-            sheet_name = 'Task Details'
-            worksheet = writer.sheets[sheet_name]
-            last_row = len(df_tasks) + 3  # Add 3 for the extra row and header
-
-            # Find the column letter for "Time Spent"
-            for idx, col in enumerate(df_tasks.columns, 1):
-                if col == "Time Spent":
-                    time_spent_col_letter = get_column_letter(idx)
-                    break
-
-            # Format the "Time Spent" column as duration and set cell value as timedelta
-            for idx, i in enumerate(df_tasks.index, start=3):
-                minutes = int(df_tasks.loc[i, "Time Spent"] * 1440)  # Convert back to minutes
-                td = timedelta(minutes=minutes)
-                cell = worksheet[f"{time_spent_col_letter}{idx}"]
-                cell.value = td  # Set as timedelta object
-                cell.number_format = '[h]:mm:ss'  # Changed from '[h]:mm' to '[h]:mm:ss'
-
-            # Add the grouped headers
-            add_grouped_headers(worksheet)
-
-            # Apply color formatting to the headers
-            color_headers(worksheet)
-
-            # Add a title above the pivot table
-            title = "Total Time Per Staff"
-            worksheet.cell(row=last_row + 1, column=1, value=title)
-
-            # Write the pivot table below the task details, starting from the title
-            for r_idx, row in pivot_df.iterrows():
-                for c_idx, value in enumerate(row):
-                    worksheet.cell(row=last_row + r_idx + 2, column=c_idx + 1, value=value)
-
-            # Add the total sum below the pivot table
-            total_label_row = last_row + len(pivot_df)
-            worksheet.cell(row=total_label_row, column=7, value="TOTAL:")
-            worksheet.cell(row=total_label_row, column=8, value=total_time_formatted)
-
-            # Adjust the width of each column to fit the content
-            for col_idx, col in enumerate(df_tasks.columns, 1):
-                max_length = max(df_tasks[col].astype(str).map(len).max(), len(col))  # Find the max length in the column
-                worksheet.column_dimensions[get_column_letter(col_idx)].width = max_length + 2  # Add a little padding
-
-            # Apply the font settings to the entire worksheet
-            set_font(worksheet, font_name="Calibri", font_size=10)
-
-        print(f"Time data and pivot table for project '{project_name}' saved to {excel_file}")
+    if EXCEL_ENGINE not in ('openpyxl', 'xlsxwriter'):
+        raise Exception(f"Unknown PWF_EXCEL_ENGINE '{EXCEL_ENGINE}', expected 'openpyxl' or 'xlsxwriter'")
+    if HTTP_CACHE_MODE not in ('off', 'on', 'record', 'replay'):
+        raise Exception(f"Unknown PWF_HTTP_CACHE '{HTTP_CACHE_MODE}', expected 'off', 'on', 'record' or 'replay'")
+    unknown_modes = [mode for mode in OUTPUT_MODES if mode not in ('files', 'workbook', 'parquet', 'csv')]
+    if unknown_modes or not OUTPUT_MODES:
+        raise Exception(f"Unknown PWF_OUTPUT_MODE '{','.join(unknown_modes)}', expected some of 'files', 'workbook', 'parquet' and 'csv'")
+    if STREAMING and OUTPUT_MODES != ['files']:
+        raise Exception("PWF_STREAMING writes one workbook per project as it goes, so it needs PWF_OUTPUT_MODE=files")
+    if 'parquet' in OUTPUT_MODES and pyarrow is None:
+        raise Exception("PWF_OUTPUT_MODE=parquet requires the pyarrow package (pip install pyarrow)")
+
+    report_months = get_report_months()
+    window_from = trackedfrom or get_tracked_window(report_months[0])[0]
+    window_to = trackedto or get_tracked_window(report_months[-1])[1]
+
+    failures = {}
+    try:
+        if STREAMING:
+            # Write each project's workbooks while the remaining contacts are still being fetched
+            exporter = TimesheetExporter()
+            try:
+                stream_timesheets(window_from, window_to, report_months, exporter, as_of_month_end=INVOICES_AS_OF_MONTH_END)
+            finally:
+                failures = exporter.finish()
+        else:
+            # Process time for all staff contacts, fetching once for every report month
+            monthly_data_tasks = process_time_per_contact(window_from, window_to, report_months, as_of_month_end=INVOICES_AS_OF_MONTH_END)
+
+            for month, project_data_tasks in monthly_data_tasks.items():
+                # Create output directory if it doesn't exist
+                output_dir = f"{OUTPUT_DIR}/{month.strftime('%B %Y')}"
+                os.makedirs(output_dir, exist_ok=True)
+                formatted_date = add_months(month, 1).strftime('%b %Y')  # Files are dated the month after the report month
+
+                # Write each project's data to a separate Excel file
+                if 'files' in OUTPUT_MODES:
+                    month_failures = export_timesheets(project_data_tasks, output_dir, formatted_date)
+                    failures.update({f"{project_name} ({month.strftime('%b %Y')})": e for project_name, e in month_failures.items()})
+
+                # Every project in one workbook, and the records and totals as data files
+                exports = {'workbook': lambda: [export_consolidated_workbook(project_data_tasks, output_dir, formatted_date)]}
+                for file_format in ('parquet', 'csv'):
+                    exports[file_format] = lambda file_format=file_format: export_records(project_data_tasks, output_dir, formatted_date, file_format)
+                for mode in OUTPUT_MODES:
+                    if mode in exports:
+                        try:
+                            output_files = exports[mode]()
+                        except Exception as e:
+                            print(f"Failed to write the {mode} output for {month.strftime('%B %Y')}: {e!r}")
+                            failures[f"{mode} output ({month.strftime('%b %Y')})"] = e
+                        else:
+                            print(f"Saved the {mode} output for {month.strftime('%B %Y')} to {', '.join(output_files)}")
+    finally:
+        # Report where the time went, even if the run failed part way through
+        print_run_report()
+
+    if failures:
+        raise Exception(f"Failed to write {len(failures)} timesheets: {', '.join(failures)}")
 
 if __name__ == "__main__":
     main()